@@ -14,28 +14,101 @@ NOTES:
 """
 
 import os
+import copy
+import asyncio
+import hashlib
+import importlib.util
+import html
 import itertools
+from collections import deque
 import re
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
 import requests
 import streamlit as st
 import pandas as pd
 from typing import List, Dict, Optional, Any
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from rapidfuzz import fuzz, process
+from cachetools import LRUCache, TTLCache, cached
+from cachetools.keys import hashkey
 import torch
 try:
-    from transformers import AutoModelForCausalLM, AutoTokenizer, set_seed
+    from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig, StoppingCriteriaList, TextIteratorStreamer, set_seed
     TRANSFORMERS_AVAILABLE = True
 except ImportError:
     TRANSFORMERS_AVAILABLE = False
     AutoModelForCausalLM = None
     AutoTokenizer = None
+    BitsAndBytesConfig = None
+    StoppingCriteriaList = None
+    TextIteratorStreamer = None
     set_seed = None
+try:
+    from transformers import DynamicCache
+except ImportError:
+    DynamicCache = None
+try:
+    from optimum.onnxruntime import ORTModelForCausalLM
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    ONNXRUNTIME_AVAILABLE = True
+except ImportError:
+    ONNXRUNTIME_AVAILABLE = False
+    ORTModelForCausalLM = None
+try:
+    import ahocorasick
+    AHOCORASICK_AVAILABLE = True
+except ImportError:
+    AHOCORASICK_AVAILABLE = False
+try:
+    import httpx
+    HTTPX_AVAILABLE = True
+    HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+except ImportError:
+    HTTPX_AVAILABLE = False
+    HTTP2_AVAILABLE = False
 from datetime import datetime
 import plotly.express as px
 import plotly.graph_objects as go
 import google.generativeai as genai
 # Removed Google API client as it's no longer used
 
+# ----------------------------
+# Process-wide shared state
+# ----------------------------
+# Streamlit re-executes this script on every rerun, so plain module globals are rebuilt each
+# time; caches and counters that must outlive a rerun are created through st.cache_resource.
+@st.cache_resource
+def shared_ttl_cache(name: str, maxsize: int, ttl: int) -> TTLCache:
+    return TTLCache(maxsize=maxsize, ttl=ttl)
+
+@st.cache_resource
+def shared_lru_cache(name: str, maxsize: int) -> LRUCache:
+    return LRUCache(maxsize=maxsize)
+
+@st.cache_resource
+def shared_counters(name: str) -> Dict[str, int]:
+    return {"hits": 0, "misses": 0}
+
+@st.cache_resource
+def shared_lock(name: str) -> threading.Lock:
+    return threading.Lock()
+
+@st.cache_resource
+def shared_http_session() -> requests.Session:
+    return requests.Session()
+
+@st.cache_resource
+def negative_cache_db(path: str) -> sqlite3.Connection:
+    """SQLite store of names RxNorm could not match, shared by all sessions and kept across restarts"""
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.execute("CREATE TABLE IF NOT EXISTS bad(k TEXT PRIMARY KEY, ts INTEGER)")
+    conn.commit()
+    return conn
+
 # ----------------------------
 # Page Configuration & Styling
 # ----------------------------
@@ -47,7 +120,7 @@ st.set_page_config(
 )
 
 # Custom CSS for enhanced styling (keeping your existing CSS)
-st.markdown("""
+APP_CSS = """
 <style>
     /* Main theme colors */
     :root {
@@ -236,24 +309,40 @@ st.markdown("""
         font-weight: 600;
     }
 </style>
-    """, unsafe_allow_html=True)
+    """
+# Streamlit drops elements a rerun does not emit, so the stylesheet is sent on every run
+st.markdown(APP_CSS, unsafe_allow_html=True)
 
-def create_metric_card(title, value, icon=""):
-    st.markdown(f"""
+METRIC_CARD_TEMPLATE = """
     <div class="metric-card">
         <div class="metric-value">{icon} {value}</div>
         <div class="metric-label">{title}</div>
     </div>
-    """, unsafe_allow_html=True)
+    """
 
-def create_alert(message, alert_type="info"):
-    st.markdown(f"""
+ALERT_TEMPLATE = """
     <div class="alert alert-{alert_type}">
         {message}
     </div>
-    """, unsafe_allow_html=True)
+    """
 
+def create_metric_card(title, value, icon=""):
+    st.markdown(METRIC_CARD_TEMPLATE.format(icon=icon, value=value, title=title), unsafe_allow_html=True)
+
+def create_alert(message, alert_type="info"):
+    st.markdown(ALERT_TEMPLATE.format(message=message, alert_type=alert_type), unsafe_allow_html=True)
+
+def progress_reporter(progress, start, span, updates=5):
+    """on_progress(done, total) callback that advances a progress bar at most ~`updates` times"""
+    def report(done, total):
+        step = max(1, total // updates)
+        if done % step == 0 or done == total:
+            progress.progress(start + done * span // total)
+    return report
+
+@st.cache_data(show_spinner=False)
 def create_severity_chart(interactions_df):
+    """Severity pie chart as a figure dict, cached on the interactions DataFrame"""
     if interactions_df.empty:
         return None
     
@@ -270,19 +359,29 @@ def create_severity_chart(interactions_df):
         }
     )
     fig.update_traces(textposition='inside', textinfo='percent+label')
-    return fig
+    return fig.to_dict()
+
+SEVERITY_STYLES = {
+    'High': 'background-color: #ffebee',
+    'Medium': 'background-color: #fff3e0',
+    'Low': 'background-color: #e8f5e8'
+}
+
+def severity_cell_styles(severities: pd.Series) -> pd.Series:
+    """CSS for each severity cell, mapped over the whole column at once"""
+    return severities.map(SEVERITY_STYLES).fillna('')
 
 def display_conversation_history():
     """Display conversation history in a chat-like interface"""
     if st.session_state.conversation_history:
         st.markdown("### 💬 Conversation History")
         
-        for i, conv in enumerate(st.session_state.conversation_history[-5:]):  # Show last 5 conversations
+        for i, conv in enumerate(list(st.session_state.conversation_history)[-5:]):  # Show last 5 conversations
             # User message
             st.markdown(f"""
             <div class="chat-message chat-user">
                 <strong>You ({conv['timestamp']}):</strong><br>
-                {conv['user']}
+                {html.escape(conv['user'])}
             </div>
             """, unsafe_allow_html=True)
             
@@ -290,7 +389,7 @@ def display_conversation_history():
             st.markdown(f"""
             <div class="chat-message chat-assistant">
                 <strong>🤖 AI Assistant:</strong><br>
-                {conv['assistant']}
+                {html.escape(conv['assistant'])}
             </div>
             """, unsafe_allow_html=True)
 
@@ -300,6 +399,7 @@ def display_conversation_history():
 def main():
     # Initialize conversation history
     initialize_conversation_history()
+    prune_session_state()
     
     create_header()
     
@@ -316,6 +416,8 @@ def main():
         st.markdown(f"**DrugBank API:** {drugbank_status}")
         st.markdown(f"**AI Model:** ✅ Loaded ({device.upper()})")
         st.markdown(f"**RxNorm API:** ✅ Available")
+        st.markdown(f"**RxNorm Cache:** {_rxcui_cache_stats['hits']} hits / {_rxcui_cache_stats['misses']} misses")
+        st.markdown(f"**AI Response Cache:** {_gen_cache_stats['hits']} hits / {_gen_cache_stats['misses']} misses")
         
         st.markdown("---")
         
@@ -332,14 +434,14 @@ def main():
         
         # Clear conversation history
         if st.button("🗑️ Clear Chat History"):
-            st.session_state.conversation_history = []
-            st.session_state.ai_context = {'current_medications': [], 'patient_info': {}, 'recent_interactions': []}
+            st.session_state.conversation_history = deque(maxlen=MAX_CONVERSATION_HISTORY)
+            st.session_state.ai_context = {'current_medications': {}, 'patient_info': {}, 'recent_interactions': []}
             st.success("Chat history cleared!")
         
         # Display current context
         if st.session_state.ai_context.get('current_medications'):
             st.markdown("**Current Meds:**")
-            for med in st.session_state.ai_context['current_medications'][:3]:
+            for med in itertools.islice(st.session_state.ai_context['current_medications'], 3):
                 st.markdown(f"• {med}")
         
         st.markdown("---")
@@ -395,7 +497,8 @@ def main():
             drug_list = [d.strip() for d in drug_input.split(",") if d.strip()]
             
             # Update AI context
-            st.session_state.ai_context['current_medications'] = drug_list
+            st.session_state.ai_context['current_medications'] = {}
+            add_context_medications(drug_list)
             
             if not drug_list:
                 create_alert("Please enter at least one medication.", "warning")
@@ -405,16 +508,14 @@ def main():
                     progress = st.progress(0)
                     progress.progress(25)
                     
-                    # Normalize drugs
-                    norm_map = {}
-                    for i, drug in enumerate(drug_list):
-                        norm_map[drug] = normalize_to_rxcui(drug)
-                        progress.progress(25 + (i + 1) * 25 // len(drug_list))
+                    # Normalize drugs (RxNorm lookups are I/O-bound, so overlap them)
+                    norm_map = normalize_drugs(drug_list, on_progress=progress_reporter(progress, 25, 25))
                     
                     progress.progress(50)
                     
                     # Display normalization results
                     st.markdown("### 📋 Drug Normalization Results")
+                    display_names = {drug: drug.title() for drug in norm_map}
                     
                     norm_col1, norm_col2 = st.columns(2)
                     
@@ -424,19 +525,22 @@ def main():
                         for drug, data in norm_map.items():
                             if data and "rxcui" in data:
                                 found_drugs.append({
-                                    "Drug": drug.title(),
+                                    "Drug": display_names[drug],
                                     "RxCUI": data["rxcui"],
                                     "Status": "✅ Found"
                                 })
                         
                         if found_drugs:
-                            st.dataframe(pd.DataFrame(found_drugs), use_container_width=True)
+                            st.dataframe(found_drugs, use_container_width=True)
                         else:
                             st.info("No drugs were successfully normalized.")
                     
                     with norm_col2:
                         st.markdown("#### ❌ Not Found")
-                        not_found = [drug.title() for drug, data in norm_map.items() if not data]
+                        not_found = [
+                            display_names[drug] + (" (lookup failed, try again)" if data else "")
+                            for drug, data in norm_map.items() if not data or "rxcui" not in data
+                        ]
                         if not_found:
                             for drug in not_found:
                                 st.markdown(f"• {drug}")
@@ -447,7 +551,12 @@ def main():
                     
                     # Check interactions
                     rxcuis = [v["rxcui"] for v in norm_map.values() if v and "rxcui" in v]
-                    interactions = check_interactions_drugbank(rxcuis) if rxcuis else []
+                    drugbank_error = None
+                    try:
+                        interactions = check_interactions_drugbank(rxcuis) if rxcuis else []
+                    except Exception as e:
+                        interactions = []
+                        drugbank_error = str(e)
                     
                     progress.progress(90)
                     
@@ -461,31 +570,28 @@ def main():
                         # Create severity chart
                         severity_chart = create_severity_chart(interactions_df)
                         if severity_chart:
-                            st.plotly_chart(severity_chart, use_container_width=True)
+                            st.plotly_chart(go.Figure(severity_chart), use_container_width=True)
                         
                         # Display interactions table
                         st.dataframe(
-                            interactions_df.style.applymap(
-                                lambda x: 'background-color: #ffebee' if x == 'High' else
-                                'background-color: #fff3e0' if x == 'Medium' else
-                                'background-color: #e8f5e8' if x == 'Low' else '',
-                                subset=['severity']
-                            ),
+                            interactions_df.style.apply(severity_cell_styles, subset=['severity']),
                             use_container_width=True
                         )
                     else:
-                        st.success("✅ No interactions found via DrugBank API!")
+                        if drugbank_error:
+                            create_alert(f"DrugBank interaction check failed ({drugbank_error}); only the local database was checked.", "danger")
+                        else:
+                            st.success("✅ No interactions found via DrugBank API!")
                         
                         # Try local DDI database
                         create_alert("Checking local database for additional interactions...", "info")
-                        local_records = load_local_ddi("local_ddi.csv")
+                        local_ddi = load_local_ddi("local_ddi.csv")
                         
-                        if local_records:
-                            found = find_ddi_local(drug_list, local_records)
+                        if not local_ddi.empty:
+                            found = find_ddi_local(drug_list, local_ddi)
                             if found:
                                 st.markdown("### 📋 Local Database Interactions")
-                                local_df = pd.DataFrame(found)
-                                st.dataframe(local_df, use_container_width=True)
+                                st.dataframe(found, use_container_width=True)
                             else:
                                 create_alert("No additional interactions found in local database.", "success")
                         else:
@@ -526,7 +632,8 @@ def main():
             
             selected_drug = st.selectbox(
                 "Select medication", 
-                options=list(medications.keys()),
+                options=MEDICATION_NAMES,
+                format_func=MEDICATION_DISPLAY_NAMES.get,
                 help="Choose from available medications with dosing rules"
             )
             
@@ -605,7 +712,7 @@ def main():
                     detail_data = {
                         "Parameter": ["Drug Name", "Patient Age", "Weight Used", "Recommended Dose", "Maximum Daily Dose"],
                         "Value": [
-                            rec.get("drug", "N/A").title(),
+                            MEDICATION_DISPLAY_NAMES.get(rec.get("drug"), rec.get("drug", "N/A").title()),
                             f"{rec.get('age_years', 'N/A')} years",
                             f"{rec.get('weight_kg', 'N/A')} kg" + (" (estimated)" if w is None else ""),
                             rec.get("dosage", "N/A"),
@@ -613,7 +720,7 @@ def main():
                         ]
                     }
                     
-                    st.dataframe(pd.DataFrame(detail_data), use_container_width=True, hide_index=True)
+                    st.dataframe(detail_data, use_container_width=True, hide_index=True)
                     
                     create_alert("⚠️ This dosage is for reference only. Always verify with current prescribing guidelines and consider patient-specific factors.", "warning")
 
@@ -658,29 +765,31 @@ def main():
             
             if alts:
                 st.markdown("### ✅ Alternative Medications Found")
+                original_title = drug_for_alt.title()
+                alt_titles = [alt.title() for alt in alts]
                 
                 # Create cards for each alternative
                 alt_cols = st.columns(min(len(alts), 3))
                 
-                for i, alt in enumerate(alts):
+                for i, alt_title in enumerate(alt_titles):
                     with alt_cols[i % 3]:
                         st.markdown(f"""
                         <div class="card card-success">
-                            <h4>💊 {alt.title()}</h4>
-                            <p><strong>Alternative to:</strong> {drug_for_alt.title()}</p>
+                            <h4>💊 {alt_title}</h4>
+                            <p><strong>Alternative to:</strong> {original_title}</p>
                             <p><small>Consult healthcare provider before switching</small></p>
                         </div>
                         """, unsafe_allow_html=True)
                 
                 # Create comparison table
                 comparison_data = {
-                    "Original Drug": [drug_for_alt.title()],
-                    "Alternatives": [", ".join([alt.title() for alt in alts])],
+                    "Original Drug": [original_title],
+                    "Alternatives": [", ".join(alt_titles)],
                     "Total Options": [len(alts)]
                 }
                 
                 st.markdown("### 📊 Summary")
-                st.dataframe(pd.DataFrame(comparison_data), use_container_width=True, hide_index=True)
+                st.dataframe(comparison_data, use_container_width=True, hide_index=True)
                 
             else:
                 create_alert(f"No alternatives found for '{drug_for_alt}' in the current database. Consider expanding the ALTERNATIVE_MAP or connecting to a comprehensive formulary API.", "warning")
@@ -749,63 +858,67 @@ def main():
 
         if extract_meds_btn:
             with st.spinner("🔄 Analyzing text and extracting medication information..."):
-                extraction_result = extract_med_info(clinical_text)
+                st.session_state.extraction_result = extract_med_info(clinical_text)
+            st.session_state.extraction_result_at = time.time()
+            st.session_state.extraction_page = 1
+            # Update AI context once per extraction, not on every rerun
+            med_names = [med["name"] for med in st.session_state.extraction_result.get("extracted_medications", [])]
+            add_context_medications(med_names)
+
+        # Results persist in session state so paging through them survives reruns
+        extraction_result = st.session_state.get("extraction_result")
+        if extraction_result is not None:
+            if "error" in extraction_result:
+                create_alert(extraction_result["error"], "danger")
+            else:
+                st.markdown("### 📊 Extraction Results")
                 
-                if "error" in extraction_result:
-                    create_alert(extraction_result["error"], "danger")
-                else:
-                    st.markdown("### 📊 Extraction Results")
+                extracted_meds = extraction_result.get("extracted_medications", [])
+                
+                if extracted_meds:
+                    # Summary metrics
+                    metric_col1, metric_col2, metric_col3 = st.columns(3)
                     
-                    extracted_meds = extraction_result.get("extracted_medications", [])
+                    with metric_col1:
+                        create_metric_card("Medications Found", str(len(extracted_meds)), "💊")
                     
-                    if extracted_meds:
-                        # Update AI context
-                        med_names = [med["name"] for med in extracted_meds]
-                        st.session_state.ai_context['current_medications'].extend(med_names)
-                        
-                        # Summary metrics
-                        metric_col1, metric_col2, metric_col3 = st.columns(3)
-                        
-                        with metric_col1:
-                            create_metric_card("Medications Found", str(len(extracted_meds)), "💊")
-                        
-                        with metric_col2:
-                            doses_found = sum(1 for med in extracted_meds if med.get("dose"))
-                            create_metric_card("Doses Identified", str(doses_found), "📏")
-                        
-                        with metric_col3:
-                            unique_names = len(set(med["name"].lower() for med in extracted_meds))
-                            create_metric_card("Unique Drugs", str(unique_names), "🔢")
-                        
-                        # Detailed results table
-                        st.markdown("### 📋 Detailed Results")
-                        
-                        results_df = pd.DataFrame(extracted_meds)
-                        results_df.index = range(1, len(results_df) + 1)
-                        results_df.columns = [col.title() for col in results_df.columns]
-                        
-                        st.dataframe(results_df, use_container_width=True)
+                    with metric_col2:
+                        doses_found = sum(1 for med in extracted_meds if med.get("dose"))
+                        create_metric_card("Doses Identified", str(doses_found), "📏")
+                    
+                    with metric_col3:
+                        unique_names = len(set(med["name"].lower() for med in extracted_meds))
+                        create_metric_card("Unique Drugs", str(unique_names), "🔢")
+                    
+                    # Detailed results table
+                    st.markdown("### 📋 Detailed Results")
+                    
+                    # Render one page at a time so long prescriptions stay responsive
+                    page_count = (len(extracted_meds) - 1) // RESULTS_PAGE_SIZE + 1
+                    page = 1
+                    if page_count > 1:
+                        page = st.number_input("Page", min_value=1, max_value=page_count, key="extraction_page")
+                    first_row = (page - 1) * RESULTS_PAGE_SIZE
+                    # Only the visible page is built and relabelled; rows are numbered from 1
+                    view = pd.DataFrame(extracted_meds[first_row:first_row + RESULTS_PAGE_SIZE]).rename(columns=str.title)
+                    view.index = pd.RangeIndex(first_row + 1, first_row + len(view) + 1)
+                    
+                    st.dataframe(view, use_container_width=True, height=min(400, 35 * (len(view) + 1)))
+                    
+                    # Visualization
+                    if len(extracted_meds) > 1:
+                        st.markdown("### 📊 Medication Distribution")
                         
-                        # Visualization
-                        if len(extracted_meds) > 1:
-                            st.markdown("### 📊 Medication Distribution")
-                            
-                            med_names = [med["name"] for med in extracted_meds]
-                            name_counts = pd.Series(med_names).value_counts()
-                            
-                            fig = px.bar(
-                                x=name_counts.index,
-                                y=name_counts.values,
-                                title="Medication Frequency in Text",
-                                labels={"x": "Medication", "y": "Mentions"}
-                            )
-                            st.plotly_chart(fig, use_container_width=True)
+                        med_names = [med["name"] for med in extracted_meds]
+                        name_counts = pd.Series(med_names).value_counts()
                         
-                    else:
-                        create_alert("No medications were extracted from the provided text. Try using more specific medication names with dosages.", "warning")
+                        st.bar_chart(name_counts, x_label="Medication", y_label="Mentions")
                     
-                    if extraction_result.get("note"):
-                        create_alert(extraction_result["note"], "info")
+                else:
+                    create_alert("No medications were extracted from the provided text. Try using more specific medication names with dosages.", "warning")
+                
+                if extraction_result.get("note"):
+                    create_alert(extraction_result["note"], "info")
 
     # Tab 5: Enhanced AI Assistant
     with tab5:
@@ -862,7 +975,7 @@ def main():
                 """, unsafe_allow_html=True)
 
                 st.markdown("**Medications in context:**")
-                for med in st.session_state.ai_context['current_medications'][-5:]:
+                for med in list(st.session_state.ai_context['current_medications'])[-5:]:
                     st.markdown(f"• {med}")
 
                 if st.session_state.ai_context.get('patient_info'):
@@ -884,28 +997,18 @@ def main():
             with st.spinner("🤖 AI is thinking and generating response..."):
                 # Extract medical entities from query
                 entities = extract_medical_entities(ai_query)
-                if entities['medications']:
-                    st.session_state.ai_context['current_medications'].extend(entities['medications'])
-                    # Remove duplicates while preserving order
-                    st.session_state.ai_context['current_medications'] = list(dict.fromkeys(st.session_state.ai_context['current_medications']))
+                add_context_medications(entities['medications'])
                 
                 # Generate response with or without context
                 context = st.session_state.ai_context if use_context else None
-                ai_response = generate_enhanced_ai_response(ai_query, context)
+                # Display the response as it is generated
+                st.markdown("### 🤖 AI Response")
+                st.markdown("**🤖 AI Assistant:**")
+                ai_response = st.write_stream(stream_enhanced_ai_response(ai_query, context))
                 
                 # Add to conversation history
                 add_to_conversation(ai_query, ai_response)
                 
-                # Display the response
-                st.markdown("### 🤖 AI Response")
-                
-                st.markdown(f"""
-                <div class="chat-message chat-assistant">
-                    <strong>🤖 AI Assistant:</strong><br>
-                    {ai_response}
-                </div>
-                """, unsafe_allow_html=True)
-                
                 # Generate follow-up questions
                 follow_ups = suggest_follow_up_questions(ai_query, ai_response)
                 
@@ -935,9 +1038,33 @@ def main():
 # Config / constants & sources
 # ----------------------------
 RXNORM_BASE = "https://rxnav.nlm.nih.gov/REST"
+RXNORM_MAX_CONCURRENCY = 8
+RXNORM_NEGATIVE_CACHE = os.getenv("RXNORM_NEGATIVE_CACHE", "rxnorm_neg.db")
+RXNORM_NEGATIVE_TTL = 7 * 86400  # retry unmatched names after a week
 DRUGBANK_BASE = "https://api.drugbank.com/v1"   # requires account/key
 DRUGBANK_API_KEY = os.getenv("DRUGBANK_API_KEY")  # set in environment if available
 GEMINI_API_KEY = None  # Gemini API key removed
+GEMINI_MODEL_NAME = "gemini-1.5-flash"
+AI_MODEL_PATH = "ibm-granite/granite-3.3-2b-instruct"
+# CPU unless a GPU is present; set AI_DEVICE=cpu to force CPU if CUDA misbehaves
+AI_DEVICE = os.getenv("AI_DEVICE", "cuda" if torch.cuda.is_available() else "cpu")
+# bitsandbytes weight quantization when installed: "4bit" (default), "8bit" or "none"
+AI_MODEL_QUANTIZATION = os.getenv("AI_MODEL_QUANTIZATION", "4bit").lower()
+def cpu_supports_bf16() -> bool:
+    """True if oneDNN has native bfloat16 kernels on this CPU (e.g. AVX512-BF16/AMX)"""
+    try:
+        return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except Exception:
+        return False
+
+# Unquantized CPU weights: bfloat16 where the CPU runs it natively, float32 otherwise (it is slower when emulated)
+AI_CPU_DTYPE = getattr(torch, os.getenv("AI_CPU_DTYPE", "bfloat16" if cpu_supports_bf16() else "float32"))
+# Tokenizer files are saved under here (one subdirectory per model) on first load so later loads skip the Hugging Face Hub
+AI_TOKENIZER_DIR = os.getenv("AI_TOKENIZER_DIR", os.path.join("model_cache", "tokenizer"))
+# "torch" (default) or "onnx": run int8 dynamically quantized weights on ONNX Runtime's CPU provider
+AI_MODEL_BACKEND = os.getenv("AI_MODEL_BACKEND", "torch").lower()
+# The ONNX export and its int8 copy are written under here (one subdirectory per model) on first load
+AI_ONNX_DIR = os.getenv("AI_ONNX_DIR", os.path.join("model_cache", "onnx"))
 
 
 # if GEMINI_API_KEY:
@@ -963,19 +1090,99 @@ Important guidelines:
 
 Format your responses clearly with appropriate sections and bullet points when helpful."""
 
+def build_quantization_config():
+    """bitsandbytes config for AI_MODEL_QUANTIZATION, or None if disabled or bitsandbytes is missing"""
+    if AI_MODEL_QUANTIZATION not in ("4bit", "8bit") or importlib.util.find_spec("bitsandbytes") is None:
+        return None
+    if AI_MODEL_QUANTIZATION == "8bit":
+        return BitsAndBytesConfig(load_in_8bit=True)
+    if AI_DEVICE == "cpu":
+        compute_dtype = AI_CPU_DTYPE
+    else:
+        compute_dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+    return BitsAndBytesConfig(
+        load_in_4bit=True,
+        bnb_4bit_quant_type="nf4",
+        bnb_4bit_compute_dtype=compute_dtype
+    )
+
+def model_cache_dir(base: str, model_path: str) -> str:
+    """Subdirectory of base for files derived from model_path, named after the model id"""
+    return os.path.join(base, re.sub(r"[^\w.-]+", "--", model_path).strip("-"))
+
+def load_tokenizer(model_path: str):
+    """Load the tokenizer for model_path from AI_TOKENIZER_DIR, downloading and saving it there the first time"""
+    local_dir = model_cache_dir(AI_TOKENIZER_DIR, model_path)
+    if os.path.isdir(local_dir):
+        return AutoTokenizer.from_pretrained(local_dir, local_files_only=True)
+    tokenizer = AutoTokenizer.from_pretrained(model_path)
+    # Save into a scratch directory and rename it into place, so a crash never leaves a partial copy
+    os.makedirs(AI_TOKENIZER_DIR, exist_ok=True)
+    scratch_dir = tempfile.mkdtemp(dir=AI_TOKENIZER_DIR, prefix=".partial-")
+    try:
+        tokenizer.save_pretrained(scratch_dir)
+        os.replace(scratch_dir, local_dir)
+    except OSError:
+        # Another process saved it first, or the directory is read-only; this load still has the tokenizer
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+    return tokenizer
+
+ONNX_INT8_FILE = "model_int8.onnx"
+
+def load_onnx_int8_model(model_path: str):
+    """ONNX Runtime model with int8 weights, exported and quantized into a per-model AI_ONNX_DIR subdirectory the first time"""
+    onnx_dir = model_cache_dir(AI_ONNX_DIR, model_path)
+    if not os.path.exists(os.path.join(onnx_dir, ONNX_INT8_FILE)):
+        # Export and quantize in a scratch directory that is renamed into place only once complete,
+        # so an interrupted first run is redone instead of leaving a broken model behind
+        os.makedirs(AI_ONNX_DIR, exist_ok=True)
+        scratch_dir = tempfile.mkdtemp(dir=AI_ONNX_DIR, prefix=".partial-")
+        try:
+            ORTModelForCausalLM.from_pretrained(model_path, export=True, use_cache=True).save_pretrained(scratch_dir)
+            quantize_dynamic(
+                os.path.join(scratch_dir, "model.onnx"), os.path.join(scratch_dir, ONNX_INT8_FILE),
+                weight_type=QuantType.QInt8, use_external_data_format=True
+            )
+            shutil.rmtree(onnx_dir, ignore_errors=True)
+            os.replace(scratch_dir, onnx_dir)
+        finally:
+            shutil.rmtree(scratch_dir, ignore_errors=True)
+    return ORTModelForCausalLM.from_pretrained(onnx_dir, file_name=ONNX_INT8_FILE, use_cache=True)
+
 @st.cache_resource
 def load_model():
     """Load the AI model with enhanced configuration"""
     if not TRANSFORMERS_AVAILABLE:
         return None, None, "cpu"
     try:
-        model_path = "ibm-granite/granite-3.3-2b-instruct"
-        device = "cpu"  # Force CPU usage to avoid CUDA issues
-        model = AutoModelForCausalLM.from_pretrained(
-            model_path,
-            torch_dtype=torch.float32,  # Use float32 for CPU
-        ).to(device)
-        tokenizer = AutoTokenizer.from_pretrained(model_path)
+        model_path = AI_MODEL_PATH
+        device = AI_DEVICE
+        quantization_config = build_quantization_config()
+        model = None
+        if AI_MODEL_BACKEND == "onnx" and ONNXRUNTIME_AVAILABLE:
+            # ONNX Runtime's int8 kernels use VNNI dot products where the CPU has them
+            device = "cpu"
+            model = load_onnx_int8_model(model_path)
+        elif quantization_config is not None:
+            try:
+                # Pin every shard to AI_DEVICE; "auto" would put them on the GPU even with AI_DEVICE=cpu
+                model = AutoModelForCausalLM.from_pretrained(
+                    model_path,
+                    quantization_config=quantization_config,
+                    device_map={"": device},
+                    low_cpu_mem_usage=True,
+                ).eval()
+            except Exception as e:
+                # e.g. a bitsandbytes build without a backend for this device
+                st.warning(f"Quantized model load failed ({str(e)}); loading unquantized weights instead.")
+        if model is None:
+            model = AutoModelForCausalLM.from_pretrained(
+                model_path,
+                torch_dtype=torch.float16 if device == "cuda" else AI_CPU_DTYPE,  # Half precision on GPU, bfloat16 for CPU
+                low_cpu_mem_usage=True,
+            ).to(device).eval()
+        model.generation_config.use_cache = True
+        tokenizer = load_tokenizer(model_path)
         return model, tokenizer, device
     except Exception as e:
         st.error(f"Failed to load AI model: {str(e)}")
@@ -990,35 +1197,183 @@ MODEL = model
 TOKENIZER = tokenizer
 DEVICE = device
 
+@st.cache_resource(max_entries=1)
+def build_system_prompt_cache(_model, _tokenizer, day: str):
+    """Token ids and precomputed KV cache for the chat-template prefix that ends with AI_SYSTEM_PROMPT.
+
+    Every local prompt starts with this prefix, so its prefill is done once and cloned per request.
+    Keyed on the day because chat templates may embed today's date.
+    """
+    if not isinstance(_model, torch.nn.Module) or _tokenizer is None or DynamicCache is None:
+        return None
+    try:
+        # Longest token prefix shared by prompts that differ only after the system prompt
+        probes = [
+            _tokenizer.apply_chat_template(
+                [{"role": "user", "content": AI_SYSTEM_PROMPT + tail}],
+                return_tensors="pt", return_dict=True, add_generation_prompt=True
+            )["input_ids"][0]
+            for tail in ("\n\nA", "\n\n\n\nB", " C")
+        ]
+        length = 0
+        while all(length < len(p) for p in probes) and len({int(p[length]) for p in probes}) == 1:
+            length += 1
+        prefix_ids = probes[0][:length].unsqueeze(0).to(DEVICE)
+        with torch.no_grad():
+            prefix_kv = _model(input_ids=prefix_ids, past_key_values=DynamicCache(), use_cache=True).past_key_values
+        return prefix_ids, prefix_kv
+    except Exception:
+        return None
+
+SYSTEM_PROMPT_CACHE = build_system_prompt_cache(MODEL, TOKENIZER, datetime.now().date().isoformat())
+
+@st.cache_resource(max_entries=1)
+def build_prompt_template(_tokenizer, day: str):
+    """Pre-tokenized chat-template head plus AI_SYSTEM_PROMPT, and the template text after the user message.
+
+    Local prompts always start with the system prompt, so per request only the remainder is rendered
+    and tokenized. None when this split does not reproduce apply_chat_template for the tokenizer.
+    """
+    if _tokenizer is None:
+        return None
+    try:
+        sentinel = "\x00PROMPT\x00"
+        rendered = _tokenizer.apply_chat_template(
+            [{"role": "user", "content": sentinel}], tokenize=False, add_generation_prompt=True
+        )
+        head, tail = rendered.split(sentinel)
+        prefix_ids = _tokenizer(head + AI_SYSTEM_PROMPT, add_special_tokens=False, return_tensors="pt")["input_ids"]
+        probe = "\n\nPrevious Q: dose?...\n\nCurrent Question: What is the dose?\n\nResponse:"
+        suffix_ids = _tokenizer(probe + tail, add_special_tokens=False, return_tensors="pt")["input_ids"]
+        expected = _tokenizer.apply_chat_template(
+            [{"role": "user", "content": AI_SYSTEM_PROMPT + probe}],
+            return_tensors="pt", return_dict=True, add_generation_prompt=True
+        )["input_ids"]
+        if not torch.equal(torch.cat([prefix_ids, suffix_ids], dim=1), expected):
+            return None
+        return prefix_ids.to(DEVICE), tail
+    except Exception:
+        return None
+
+PROMPT_TEMPLATE = build_prompt_template(TOKENIZER, datetime.now().date().isoformat())
+
+def encode_local_prompt(prompt: str):
+    """Chat-formatted input ids for a single-turn prompt, reusing the pre-tokenized system prefix when possible"""
+    if PROMPT_TEMPLATE is not None and prompt.startswith(AI_SYSTEM_PROMPT):
+        prefix_ids, tail = PROMPT_TEMPLATE
+        suffix = TOKENIZER(prompt[len(AI_SYSTEM_PROMPT):] + tail, add_special_tokens=False, return_tensors="pt")["input_ids"]
+        return torch.cat([prefix_ids, suffix.to(DEVICE)], dim=1)
+    conv = [{"role": "user", "content": prompt}]
+    return TOKENIZER.apply_chat_template(conv, return_tensors="pt", return_dict=True, add_generation_prompt=True)["input_ids"].to(DEVICE)
+
+def system_prompt_kv_for(input_ids):
+    """A private copy of the system-prompt KV cache if input_ids start with its prefix, else None"""
+    if SYSTEM_PROMPT_CACHE is None:
+        return None
+    prefix_ids, prefix_kv = SYSTEM_PROMPT_CACHE
+    length = prefix_ids.shape[1]
+    if input_ids.shape[1] <= length or not torch.equal(input_ids[:, :length], prefix_ids):
+        return None
+    return copy.deepcopy(prefix_kv)
+
 # ----------------------------
 # Enhanced AI Assistant Functions
 # ----------------------------
+# Generated answers keyed on model + prompt inputs; repeated questions skip search and generation
+_gen_cache = shared_ttl_cache("ai_responses", maxsize=1024, ttl=600)
+_gen_cache_stats = shared_counters("ai_responses")
+_gen_cache_lock = shared_lock("ai_responses")
+
+def get_cached_response(key) -> Optional[str]:
+    """Cached AI response for key, or None; counts the lookup"""
+    with _gen_cache_lock:
+        value = _gen_cache.get(key)
+        _gen_cache_stats["misses" if value is None else "hits"] += 1
+    return value
+
+def set_cached_response(key, response: str):
+    with _gen_cache_lock:
+        _gen_cache[key] = response
+
+def response_cache_key(model_name: str, *prompt_parts: str) -> tuple:
+    """Digest of the canonicalized (lowercased, whitespace-collapsed) prompt inputs"""
+    canonical = "\x1f".join(" ".join(part.lower().split()) for part in prompt_parts)
+    return model_name, hashlib.blake2b(canonical.encode(), digest_size=16).digest()
+
+# Keep only the last few conversations to manage memory; the deque drops older ones
+MAX_CONVERSATION_HISTORY = 10
+
 def initialize_conversation_history():
     """Initialize conversation history in session state"""
-    if 'conversation_history' not in st.session_state:
-        st.session_state.conversation_history = []
+    if not isinstance(st.session_state.get('conversation_history'), deque):
+        st.session_state.conversation_history = deque(st.session_state.get('conversation_history', []), maxlen=MAX_CONVERSATION_HISTORY)
     if 'ai_context' not in st.session_state:
         st.session_state.ai_context = {
-            'current_medications': [],
+            'current_medications': {},
             'patient_info': {},
             'recent_interactions': []
         }
+    elif isinstance(st.session_state.ai_context.get('current_medications'), list):
+        st.session_state.ai_context['current_medications'] = dict.fromkeys(st.session_state.ai_context['current_medications'])
+
+# Conversation turns and extraction results older than this are dropped from the session
+SESSION_ENTRY_MAX_AGE = 30 * 60
+# Longest question or answer text kept per stored conversation turn
+MAX_CONVERSATION_TEXT = 4096
+
+def prune_session_state():
+    """Drop conversation turns and the stored extraction result once they are older than SESSION_ENTRY_MAX_AGE"""
+    cutoff = time.time() - SESSION_ENTRY_MAX_AGE
+    history = st.session_state.conversation_history
+    while history and history[0].get('created_at', 0) < cutoff:
+        history.popleft()
+    if st.session_state.get('extraction_result_at', 0) < cutoff:
+        st.session_state.pop('extraction_result', None)
+        st.session_state.pop('extraction_result_at', None)
+
+# Medications remembered for AI context, as an insertion-ordered dict used as a set
+MAX_CONTEXT_MEDICATIONS = 50
+
+def add_context_medications(names: List[str]):
+    """Add medications to the AI context once each, dropping the oldest beyond MAX_CONTEXT_MEDICATIONS"""
+    meds = st.session_state.ai_context['current_medications']
+    for name in names:
+        meds.setdefault(name, None)
+    while len(meds) > MAX_CONTEXT_MEDICATIONS:
+        del meds[next(iter(meds))]
+
+# Token budget for previous exchanges included in the prompt, newest first
+CONVERSATION_TOKEN_BUDGET = 256
+
+def count_tokens(text: str) -> int:
+    """Prompt token count for text (roughly 4 characters per token when no tokenizer is loaded)"""
+    if TOKENIZER is None:
+        return len(text) // 4 + 1
+    return len(TOKENIZER(text, add_special_tokens=False)["input_ids"])
+
+def format_conversation_turn(conv: Dict) -> str:
+    return f"Previous Q: {conv['user'][:100]}...\nPrevious A: {conv['assistant'][:200]}...\n"
 
 def add_to_conversation(user_input: str, ai_response: str):
     """Add conversation to history"""
     timestamp = datetime.now().strftime("%H:%M:%S")
-    st.session_state.conversation_history.append({
+    conv = {
         'timestamp': timestamp,
-        'user': user_input,
-        'assistant': ai_response
-    })
-    
-    # Keep only last 10 conversations to manage memory
-    if len(st.session_state.conversation_history) > 10:
-        st.session_state.conversation_history = st.session_state.conversation_history[-10:]
+        'created_at': time.time(),
+        'user': user_input[:MAX_CONVERSATION_TEXT],
+        'assistant': ai_response[:MAX_CONVERSATION_TEXT]
+    }
+    conv['tokens'] = count_tokens(format_conversation_turn(conv))
+    st.session_state.conversation_history.append(conv)
 
-def generate_enhanced_ai_response(query: str, context: Dict = None) -> str:
-    """Generate AI response with enhanced prompting and context awareness"""
+def stop_when_set(event: threading.Event):
+    """generate() stopping criterion that ends every sequence once event is set"""
+    def criterion(input_ids, scores, **kwargs):
+        return torch.full((input_ids.shape[0],), event.is_set(), dtype=torch.bool, device=input_ids.device)
+    return criterion
+
+def stream_enhanced_ai_response(query: str, context: Dict = None):
+    """Generate AI response with enhanced prompting and context awareness, yielding text as it arrives"""
 
     # Build context-aware prompt
     context_info = ""
@@ -1028,23 +1383,38 @@ def generate_enhanced_ai_response(query: str, context: Dict = None) -> str:
         if st.session_state.ai_context.get('patient_info'):
             context_info += f"Patient information: {st.session_state.ai_context['patient_info']}\n"
 
-    # Include recent conversation context
-    conversation_context = ""
-    if len(st.session_state.conversation_history) > 0:
-        recent_conv = st.session_state.conversation_history[-2:]  # Last 2 exchanges
-        for conv in recent_conv:
-            conversation_context += f"Previous Q: {conv['user'][:100]}...\nPrevious A: {conv['assistant'][:200]}...\n"
+    # Include recent conversation context, newest exchanges first until the token budget is spent
+    recent_conv = []
+    used_tokens = 0
+    for conv in reversed(st.session_state.conversation_history):
+        tokens = conv.get('tokens') or count_tokens(format_conversation_turn(conv))
+        if used_tokens + tokens > CONVERSATION_TOKEN_BUDGET:
+            break
+        recent_conv.append(conv)
+        used_tokens += tokens
+    conversation_context = "".join(format_conversation_turn(conv) for conv in reversed(recent_conv))
+
+    # Everything the prompt depends on is known here (search results derive from the query)
+    cache_key = response_cache_key(GEMINI_MODEL_NAME if GEMINI_API_KEY else AI_MODEL_PATH, query, context_info, conversation_context)
+    cached_response = get_cached_response(cache_key)
+    if cached_response is not None:
+        yield cached_response
+        return
 
     # Get online search results for medical queries
     online_search_results = ""
     query_lower = query.lower()
     # Check if query is medical-related and worth searching online
     medical_keywords = ['dosage', 'dose', 'interaction', 'side effect', 'contraindication', 'medication', 'drug', 'treatment', 'symptom']
-    if any(keyword in query_lower for keyword in medical_keywords):
+    # Without a Gemini key there is nothing to search; don't spend a call or prompt tokens on it
+    if GEMINI_API_KEY and any(keyword in query_lower for keyword in medical_keywords):
         try:
             online_search_results = search_online(query)
-            if online_search_results and "Online search not available" not in online_search_results:
+            # Only actual results go into the prompt, not "no information" or error notices
+            if online_search_results.startswith(SEARCH_RESULTS_HEADER):
                 online_search_results = f"\nAdditional Online Information:\n{online_search_results}\n"
+            else:
+                online_search_results = ""
         except Exception as e:
             online_search_results = f"\nNote: Online search temporarily unavailable: {str(e)}\n"
 
@@ -1070,51 +1440,92 @@ Response:"""
 
     # Try Gemini first if available
     if GEMINI_API_KEY:
+        chunks = []
         try:
-            model = genai.GenerativeModel('gemini-1.5-flash')
-            response = model.generate_content(enhanced_prompt)
-            if response and response.text:
-                return response.text.strip()
+            model = genai.GenerativeModel(GEMINI_MODEL_NAME)
+            for chunk in model.generate_content(enhanced_prompt, stream=True):
+                if chunk.text:
+                    chunks.append(chunk.text)
+                    yield chunk.text
         except Exception as e:
+            if chunks:
+                # Part of the answer is already on screen; flag it and keep it out of the cache
+                yield f"\n\n⚠️ The response was cut off by a Gemini API error ({str(e)}). Please ask again for a complete answer."
+                return
             st.warning(f"Gemini API error: {str(e)}. Falling back to local model.")
+        else:
+            if chunks:
+                set_cached_response(cache_key, "".join(chunks).strip())
+                return
 
     # Fall back to local model if available
     if MODEL and TOKENIZER and TRANSFORMERS_AVAILABLE:
         try:
-            # Prepare conversation for the model
-            conv = [{"role": "user", "content": enhanced_prompt}]
-
-            # Generate response
-            inputs = TOKENIZER.apply_chat_template(conv, return_tensors="pt", add_generation_prompt=True).to(DEVICE)
+            # Generate response on a worker thread and stream decoded text back
+            inputs = encode_local_prompt(enhanced_prompt)
             set_seed(42)
 
-            with torch.no_grad():
-                output = MODEL.generate(
-                    input_ids=inputs,
-                    max_new_tokens=800,  # Increased for more comprehensive responses
-                    temperature=0.6,     # Slightly lower for more focused responses
-                    do_sample=True,
-                    pad_token_id=TOKENIZER.eos_token_id,
-                    repetition_penalty=1.1,
-                    top_p=0.9
-                )
-
-            input_length = inputs.shape[1]
-            generated_tokens = output[0][input_length:]
-            response = TOKENIZER.decode(generated_tokens, skip_special_tokens=True)
+            streamer = TextIteratorStreamer(TOKENIZER, skip_prompt=True, skip_special_tokens=True)
+            errors = []
+            # Set when the consumer stops reading (e.g. a rerun drops the stream) so generation ends early
+            stop = threading.Event()
+            # Reuse the precomputed system-prompt prefill; generate only processes the remainder
+            past_key_values = system_prompt_kv_for(inputs)
+
+            def run_generation():
+                try:
+                    MODEL.generate(
+                        input_ids=inputs,
+                        past_key_values=past_key_values,
+                        streamer=streamer,
+                        stopping_criteria=StoppingCriteriaList([stop_when_set(stop)]),
+                        max_new_tokens=800,  # Increased for more comprehensive responses
+                        temperature=0.6,     # Slightly lower for more focused responses
+                        do_sample=True,
+                        pad_token_id=TOKENIZER.eos_token_id,
+                        repetition_penalty=1.1,
+                        top_p=0.9
+                    )
+                except Exception as e:
+                    errors.append(e)
+                    streamer.end()
+
+            worker = threading.Thread(target=run_generation, daemon=True)
+            worker.start()
+            chunks = []
+            try:
+                for text in streamer:
+                    chunks.append(text)
+                    yield text
+            finally:
+                stop.set()
+            worker.join()
+            if errors:
+                raise errors[0]
 
             # Post-process response
-            response = response.strip()
+            response = "".join(chunks).strip()
             if len(response) == 0:
-                response = "I apologize, but I couldn't generate a response for that query. Please try rephrasing your question or provide more specific details."
-
-            return response
+                yield "I apologize, but I couldn't generate a response for that query. Please try rephrasing your question or provide more specific details."
+            else:
+                set_cached_response(cache_key, response)
+            return
 
         except Exception as e:
-            return f"Error generating response with local model: {str(e)}. Please try again with a different question."
+            yield f"Error generating response with local model: {str(e)}. Please try again with a different question."
+            return
 
     # If no AI models are available
-    return "AI models are not available. Please ensure you have either Gemini API key set or transformers library installed with a compatible model."
+    yield "AI models are not available. Please ensure you have either Gemini API key set or transformers library installed with a compatible model."
+
+# Drug names recognised in user questions, scanned in one pass with find_drug_names
+ENTITY_MEDICATION_NAMES = (
+    "paracetamol", "ibuprofen", "aspirin", "warfarin", "metformin", "omeprazole", "atorvastatin",
+    "lisinopril", "amoxicillin", "azithromycin", "prednisone", "ciprofloxacin", "levothyroxine",
+)
+# Simple regex patterns for entity extraction
+_ENTITY_DOSAGE_RE = re.compile(r'\b\d+(?:\.\d+)?\s*(?:mg|mcg|g|ml|units?)\b', re.IGNORECASE)
+_ENTITY_AGE_RE = re.compile(r'\b\d+(?:\.\d+)?\s*(?:year|yr|month|mo)s?(?:\s+old)?\b', re.IGNORECASE)
 
 def extract_medical_entities(text: str) -> Dict:
     """Extract medical entities from user input to build context"""
@@ -1125,14 +1536,9 @@ def extract_medical_entities(text: str) -> Dict:
         'ages': []
     }
     
-    # Simple regex patterns for entity extraction
-    med_pattern = r'\b(?:paracetamol|ibuprofen|aspirin|warfarin|metformin|omeprazole|atorvastatin|lisinopril|amoxicillin|azithromycin|prednisone|ciprofloxacin|levothyroxine)\b'
-    dosage_pattern = r'\b\d+(?:\.\d+)?\s*(?:mg|mcg|g|ml|units?)\b'
-    age_pattern = r'\b\d+(?:\.\d+)?\s*(?:year|yr|month|mo)s?(?:\s+old)?\b'
-    
-    entities['medications'] = re.findall(med_pattern, text, re.IGNORECASE)
-    entities['dosages'] = re.findall(dosage_pattern, text, re.IGNORECASE)
-    entities['ages'] = re.findall(age_pattern, text, re.IGNORECASE)
+    entities['medications'] = [name for _, _, name in find_drug_names(text, ENTITY_MEDICATION_NAMES)]
+    entities['dosages'] = _ENTITY_DOSAGE_RE.findall(text)
+    entities['ages'] = _ENTITY_AGE_RE.findall(text)
     
     return entities
 
@@ -1165,17 +1571,19 @@ def suggest_follow_up_questions(query: str, response: str) -> List[str]:
 
     return follow_ups[:3]  # Return max 3 suggestions
 
+SEARCH_RESULTS_HEADER = "Gemini AI Search Results:"
+
 def search_online(query: str) -> str:
     """Search online using Gemini API for medical information"""
     if not GEMINI_API_KEY:
         return "Gemini API key not configured. Please set GEMINI_API_KEY environment variable."
 
     try:
-        model = genai.GenerativeModel('gemini-1.5-flash')
+        model = genai.GenerativeModel(GEMINI_MODEL_NAME)
         search_prompt = f"Please provide accurate, up-to-date medical information for the following query: {query}. Include relevant drug information, dosages, interactions, or medical facts from reliable sources."
         response = model.generate_content(search_prompt)
         if response and response.text:
-            return f"Gemini AI Search Results:\n{response.text.strip()}"
+            return f"{SEARCH_RESULTS_HEADER}\n{response.text.strip()}"
         else:
             return "No information found from Gemini API."
     except Exception as e:
@@ -1186,10 +1594,21 @@ def search_online(query: str) -> str:
 # ----------------------------
 # All existing utility functions (keeping them unchanged)
 # ----------------------------
+# In-memory caches for remote lookups; repeat queries within a day skip the network
+_rxcui_cache = shared_ttl_cache("rxcui", maxsize=4096, ttl=86400)
+_rxcui_cache_lock = shared_lock("rxcui")
+_rxcui_cache_stats = shared_counters("rxcui")
+_CACHE_MISS = object()
+_interactions_cache = shared_ttl_cache("interactions", maxsize=1024, ttl=86400)
+_interactions_cache_lock = shared_lock("interactions")
+
+# Shared HTTP session so RxNorm and DrugBank calls reuse pooled TCP/TLS connections
+_http = shared_http_session()
+
 def fetch_drug_properties(rxcui: str) -> Optional[Dict]:
     """ Fetch properties for a given RxCUI from RxNorm. """
     try:
-        resp = requests.get(f"{RXNORM_BASE}/rxcui/{rxcui}/properties.json", timeout=6)
+        resp = _http.get(f"{RXNORM_BASE}/rxcui/{rxcui}/properties.json", timeout=6)
         resp.raise_for_status()
         j = resp.json()
         return j.get("properties", {})
@@ -1199,92 +1618,247 @@ def fetch_drug_properties(rxcui: str) -> Optional[Dict]:
 def fetch_related_concepts(rxcui: str) -> Optional[Dict]:
     """ Fetch related concepts for a given RxCUI from RxNorm. """
     try:
-        resp = requests.get(f"{RXNORM_BASE}/rxcui/{rxcui}/related.json", timeout=6)
+        resp = _http.get(f"{RXNORM_BASE}/rxcui/{rxcui}/related.json", timeout=6)
         resp.raise_for_status()
         j = resp.json()
         return j.get("relatedGroup", {})
     except Exception:
         return None
 
-def normalize_to_rxcui(name: str) -> Optional[Dict]:
-    """ Map free-text drug name to RxCUI and fetch full data using RxNorm REST API. """
+def get_cached_rxcui(name: str):
+    """Cached normalization result for name, or _CACHE_MISS; counts the lookup"""
+    with _rxcui_cache_lock:
+        value = _rxcui_cache.get(name.lower().strip(), _CACHE_MISS)
+        _rxcui_cache_stats["misses" if value is _CACHE_MISS else "hits"] += 1
+    return value
+
+def set_cached_rxcui(name: str, value: Optional[Dict]):
+    with _rxcui_cache_lock:
+        _rxcui_cache[name.lower().strip()] = value
+
+_neg_db = negative_cache_db(RXNORM_NEGATIVE_CACHE)
+_neg_db_lock = shared_lock("rxnorm_negative")
+
+def is_known_unmatchable(name: str) -> bool:
+    """True if RxNorm returned no match for name within RXNORM_NEGATIVE_TTL"""
+    with _neg_db_lock:
+        row = _neg_db.execute("SELECT ts FROM bad WHERE k=?", (name.lower().strip(),)).fetchone()
+    return row is not None and time.time() - row[0] < RXNORM_NEGATIVE_TTL
+
+def remember_unmatchable(name: str):
+    with _neg_db_lock, _neg_db:
+        _neg_db.execute("INSERT OR REPLACE INTO bad(k, ts) VALUES (?, ?)", (name.lower().strip(), int(time.time())))
+
+def lookup_rxcui(name: str) -> Optional[Dict]:
+    """ Map free-text drug name to RxCUI and fetch full data using RxNorm REST API.
+
+    None means RxNorm has no match; a failed request returns {"error": ...} instead.
+    """
     try:
-        resp = requests.get(f"{RXNORM_BASE}/rxcui.json", params={"name": name, "search": 1}, timeout=6)
+        resp = _http.get(f"{RXNORM_BASE}/rxcui.json", params={"name": name, "search": 1}, timeout=6)
         resp.raise_for_status()
         j = resp.json()
-        ids = j.get("idGroup", {}).get("rxnormId")
-        if ids:
-            rxcui = str(ids[0])
-            properties = fetch_drug_properties(rxcui)
-            related = fetch_related_concepts(rxcui)
-            return {"rxcui": rxcui, "properties": properties, "related": related}
     except Exception as e:
-        pass
-    return None
+        return {"error": str(e)}
+    ids = j.get("idGroup", {}).get("rxnormId")
+    if not ids:
+        remember_unmatchable(name)
+        return None
+    rxcui = str(ids[0])
+    # Properties and related concepts are independent requests; issue them together
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        properties_future = pool.submit(fetch_drug_properties, rxcui)
+        related_future = pool.submit(fetch_related_concepts, rxcui)
+        properties, related = properties_future.result(), related_future.result()
+    return {"rxcui": rxcui, "properties": properties, "related": related}
+
+def is_cacheable_lookup(value: Optional[Dict]) -> bool:
+    """True for a confirmed no-match or a complete lookup; failed or partial requests are retried next time"""
+    return value is None or (value.get("properties") is not None and value.get("related") is not None)
+
+async def fetch_rxnorm_json_async(client, path: str, params: Optional[Dict] = None) -> Optional[Dict]:
+    try:
+        resp = await client.get(f"{RXNORM_BASE}/{path}", params=params)
+        resp.raise_for_status()
+        return resp.json()
+    except Exception:
+        return None
 
+async def lookup_rxcui_async(name: str, client) -> Optional[Dict]:
+    """ Async lookup_rxcui; properties and related concepts are requested concurrently. """
+    j = await fetch_rxnorm_json_async(client, "rxcui.json", {"name": name, "search": 1})
+    if j is None:
+        return {"error": "RxNorm request failed"}
+    ids = j.get("idGroup", {}).get("rxnormId")
+    if not ids:
+        remember_unmatchable(name)
+        return None
+    rxcui = str(ids[0])
+    properties, related = await asyncio.gather(
+        fetch_rxnorm_json_async(client, f"rxcui/{rxcui}/properties.json"),
+        fetch_rxnorm_json_async(client, f"rxcui/{rxcui}/related.json")
+    )
+    return {
+        "rxcui": rxcui,
+        "properties": properties.get("properties", {}) if properties is not None else None,
+        "related": related.get("relatedGroup", {}) if related is not None else None
+    }
+
+async def lookup_rxcuis_async(names: List[str], on_result):
+    """Look up all names over one (HTTP/2 when available) httpx client, reporting each result as it lands"""
+    limits = httpx.Limits(max_connections=RXNORM_MAX_CONCURRENCY)
+    semaphore = asyncio.Semaphore(RXNORM_MAX_CONCURRENCY)
+    async with httpx.AsyncClient(http2=HTTP2_AVAILABLE, timeout=10, limits=limits) as client:
+        async def lookup(name):
+            async with semaphore:
+                return name, await lookup_rxcui_async(name, client)
+        for next_done in asyncio.as_completed([lookup(name) for name in names]):
+            on_result(*await next_done)
+
+def normalize_drugs(drug_list: List[str], on_progress=None) -> Dict[str, Optional[Dict]]:
+    """Normalize several drug names concurrently; cached names skip the network.
+
+    Uses httpx when installed and falls back to a thread pool over the requests session.
+    on_progress(done, total) is called from the calling thread.
+    """
+    names = list(dict.fromkeys(drug_list))
+    norm_map = {}
+    pending = []
+    for name in names:
+        value = get_cached_rxcui(name)
+        if value is not _CACHE_MISS:
+            norm_map[name] = value
+        elif is_known_unmatchable(name):
+            set_cached_rxcui(name, None)
+            norm_map[name] = None
+        else:
+            pending.append(name)
+
+    def record(name, value):
+        if is_cacheable_lookup(value):
+            set_cached_rxcui(name, value)
+        norm_map[name] = value
+        if on_progress:
+            on_progress(len(norm_map), len(names))
+
+    if pending and HTTPX_AVAILABLE:
+        asyncio.run(lookup_rxcuis_async(pending, record))
+    elif pending:
+        with ThreadPoolExecutor(max_workers=min(RXNORM_MAX_CONCURRENCY, len(pending))) as executor:
+            futures = {executor.submit(lookup_rxcui, name): name for name in pending}
+            for future in as_completed(futures):
+                record(futures[future], future.result())
+    return {name: norm_map[name] for name in names}
+
+@cached(_interactions_cache, key=lambda rxcui_list: hashkey(tuple(sorted(rxcui_list))), lock=_interactions_cache_lock)
 def check_interactions_drugbank(rxcui_list: List[str]) -> List[Dict]:
-    """Example flow to call DrugBank Clinical API's interaction checker."""
+    """Example flow to call DrugBank Clinical API's interaction checker.
+
+    Request failures raise instead of returning [], so they are never cached as "no interactions".
+    """
     if not DRUGBANK_API_KEY:
         return []
     headers = {"Authorization": DRUGBANK_API_KEY, "Accept": "application/json"}
-    try:
-        url = f"{DRUGBANK_BASE}/drug_interactions"
-        payload = {"product_concept_ids": rxcui_list}
-        r = requests.post(url, headers=headers, json=payload, timeout=12)
-        r.raise_for_status()
-        j = r.json()
-        interactions = []
-        for it in j.get("interactions", []):
-            interactions.append({
-                "drug_a": it.get("drug_a"),
-                "drug_b": it.get("drug_b"),
-                "severity": it.get("severity"),
-                "description": it.get("description"),
-                "source": "DrugBank"
-            })
-        return interactions
-    except Exception as e:
-        return []
-
-def load_local_ddi(path="local_ddi.csv"):
-    """Expects CSV with columns: drug_a, drug_b, severity, description, source"""
+    url = f"{DRUGBANK_BASE}/drug_interactions"
+    payload = {"product_concept_ids": rxcui_list}
+    r = _http.post(url, headers=headers, json=payload, timeout=12)
+    r.raise_for_status()
+    j = r.json()
+    interactions = []
+    for it in j.get("interactions", []):
+        interactions.append({
+            "drug_a": it.get("drug_a"),
+            "drug_b": it.get("drug_b"),
+            "severity": it.get("severity"),
+            "description": it.get("description"),
+            "source": "DrugBank"
+        })
+    return interactions
+
+@st.cache_data(show_spinner=False)
+def load_local_ddi(path="local_ddi.csv") -> pd.DataFrame:
+    """Expects CSV with columns: drug_a, drug_b, severity, description, source.
+
+    The CSV is parsed once into a Parquet copy beside it, with drug names stored as categoricals;
+    later loads read that copy for as long as it is newer than the CSV.
+    """
     if not os.path.exists(path):
-        return []
+        return pd.DataFrame()
+    parquet_path = os.path.splitext(path)[0] + ".parquet"
+    if os.path.exists(parquet_path) and os.path.getmtime(parquet_path) >= os.path.getmtime(path):
+        try:
+            return pd.read_parquet(parquet_path)
+        except Exception:
+            pass  # unreadable copy; rebuild it from the CSV below
     df = pd.read_csv(path)
-    return df.to_dict(orient="records")
-
-def find_ddi_local(drug_names: List[str], local_records: List[Dict], fuzz_threshold: int = 85):
-    db_drugs = set()
-    for r in local_records:
-        db_drugs.add(str(r.get("drug_a","")).lower())
-        db_drugs.add(str(r.get("drug_b","")).lower())
-    db_list = [d for d in db_drugs if d]
-
-    mapping = {}
-    for d in drug_names:
-        res = process.extractOne(d.lower(), db_list, scorer=fuzz.token_sort_ratio)
-        if res and res[1] >= fuzz_threshold:
-            mapping[d] = res[0]
-        else:
-            mapping[d] = None
-
-    found = []
-    for a,b in itertools.combinations(drug_names, 2):
-        ma, mb = mapping.get(a), mapping.get(b)
-        if not ma or not mb:
-            continue
-        for rec in local_records:
-            ra = str(rec.get("drug_a","")).lower()
-            rb = str(rec.get("drug_b","")).lower()
-            if (ra == ma and rb == mb) or (ra == mb and rb == ma):
-                found.append({
-                    "drug_a": a, "drug_b": b,
-                    "matched_a": ma, "matched_b": mb,
-                    "severity": rec.get("severity"),
-                    "description": rec.get("description"),
-                    "source": rec.get("source","local")
-                })
-    return found
+    df = df.astype({col: "category" for col in ("drug_a", "drug_b") if col in df})
+    # Write to a scratch file and rename it into place, so readers never see a partial copy
+    scratch_path = None
+    try:
+        fd, scratch_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix=".partial-", suffix=".parquet")
+        os.close(fd)
+        df.to_parquet(scratch_path)
+        os.replace(scratch_path, parquet_path)
+    except Exception:
+        # no Parquet engine or read-only directory; the CSV is parsed again next time
+        if scratch_path and os.path.exists(scratch_path):
+            os.remove(scratch_path)
+    return df
+
+@st.cache_data(show_spinner=False)
+def local_ddi_vocabulary(local_ddi: pd.DataFrame) -> List[str]:
+    """Distinct lower-cased drug names in the local DDI records"""
+    ddi = local_ddi.reindex(columns=["drug_a", "drug_b"])
+    db_drugs = set(pd.concat([ddi["drug_a"].astype(str), ddi["drug_b"].astype(str)]).str.lower())
+    return sorted(d for d in db_drugs if d)
+
+LOCAL_DDI_RESULT_COLUMNS = ["drug_a", "drug_b", "matched_a", "matched_b", "severity", "description", "source"]
+
+@st.cache_data(show_spinner=False)
+def local_ddi_table(local_ddi: pd.DataFrame) -> pd.DataFrame:
+    """Local DDI records keyed by lower-cased drug pair, listed in both orientations"""
+    ddi = local_ddi if "source" in local_ddi else local_ddi.assign(source="local")
+    ddi = ddi.reindex(columns=["drug_a", "drug_b", "severity", "description", "source"])
+    keyed = pd.DataFrame({
+        "matched_a": ddi["drug_a"].astype(str).str.lower(),
+        "matched_b": ddi["drug_b"].astype(str).str.lower(),
+        "record": range(len(ddi)),
+        "severity": ddi["severity"],
+        "description": ddi["description"],
+        "source": ddi["source"],
+    })
+    swapped = keyed[keyed["matched_a"] != keyed["matched_b"]].rename(
+        columns={"matched_a": "matched_b", "matched_b": "matched_a"}
+    )
+    return pd.concat([keyed, swapped], ignore_index=True)
+
+def find_ddi_local(drug_names: List[str], local_ddi: pd.DataFrame, fuzz_threshold: int = 85):
+    db_list = local_ddi_vocabulary(local_ddi)
+
+    # Exact vocabulary hits need no fuzzy matching
+    vocabulary = set(db_list)
+    mapping = {d: (d.lower() if d.lower() in vocabulary else None) for d in drug_names}
+    misses = [d for d in drug_names if mapping[d] is None]
+    if db_list and misses:
+        # Score the remaining inputs against the whole vocabulary in one native call
+        scores = process.cdist(
+            [d.lower() for d in misses], db_list,
+            scorer=fuzz.token_sort_ratio, score_cutoff=fuzz_threshold, workers=-1
+        )
+        best = scores.argmax(axis=1)
+        for row, d in enumerate(misses):
+            if scores[row, best[row]] >= fuzz_threshold:
+                mapping[d] = db_list[best[row]]
+
+    # Hash-join every input pair against the oriented record table
+    pairs = pd.DataFrame(itertools.combinations(drug_names, 2), columns=["drug_a", "drug_b"])
+    pairs["pair"] = range(len(pairs))
+    pairs["matched_a"] = pairs["drug_a"].map(mapping)
+    pairs["matched_b"] = pairs["drug_b"].map(mapping)
+    pairs = pairs.dropna(subset=["matched_a", "matched_b"])
+    hits = pairs.merge(local_ddi_table(local_ddi), on=["matched_a", "matched_b"])
+    hits = hits.sort_values(["pair", "record"], kind="stable")
+    return hits[LOCAL_DDI_RESULT_COLUMNS].to_dict(orient="records")
 
 # Medications data (keeping existing)
 medications = {
@@ -1341,15 +1915,40 @@ medications = {
     ]
 }
 
+MEDICATION_NAMES = tuple(medications.keys())
+MEDICATION_DISPLAY_NAMES = {name: name.title() for name in MEDICATION_NAMES}
+
 ALTERNATIVE_MAP = {
     "warfarin": ["dabigatran", "apixaban", "rivaroxaban"],
     "ibuprofen": ["paracetamol"],
 }
 
+def build_alternative_index(alternative_map: Dict[str, List[str]]) -> Dict[str, List[str]]:
+    """Map every drug in an alternatives group (key or listed alternative) to the rest of its group"""
+    index = {}
+    for drug, alts in alternative_map.items():
+        group = [drug] + list(alts)
+        for member in group:
+            others = index.setdefault(member.lower(), [])
+            others.extend(x for x in group if x.lower() != member.lower() and x not in others)
+    return index
+
+ALTERNATIVE_INDEX = build_alternative_index(ALTERNATIVE_MAP)
+
+# Dose string patterns shared by the dosing helpers
+_MAX_DOSE_RE = re.compile(r"(\d+(\.\d+)?)\s*(mg|mcg|g)")
+_PER_KG_DOSE_RE = re.compile(r"(\d+(\.\d+)?)(–(\d+(\.\d+)?))?\s*(mg|mcg|g)/kg")
+_FIXED_DOSE_RE = re.compile(r"(\d+)(–(\d+))?\s*(mg|mcg|g)")
+
+# Dose results memoized on their exact inputs; the rule table has few distinct dose strings
+_dose_cache = shared_lru_cache("doses", maxsize=4096)
+_dose_cache_lock = shared_lock("doses")
+
 # [Keep all existing utility functions - adjust_max_for_age_weight, calculate_dose, etc.]
+@cached(_dose_cache, key=lambda *args: hashkey("max", *args), lock=_dose_cache_lock)
 def adjust_max_for_age_weight(max_str, age, weight):
     """Reduce maximum doses conservatively for elderly and low weight patients."""
-    match = re.search(r"(\d+(\.\d+)?)\s*(mg|mcg|g)", max_str)
+    match = _MAX_DOSE_RE.search(max_str)
     if not match:
         return max_str
 
@@ -1375,9 +1974,10 @@ def adjust_max_for_age_weight(max_str, age, weight):
     else:
         return f"{value:.0f} {unit}/day (adjusted)"
 
+@cached(_dose_cache, key=lambda *args: hashkey("dose", *args), lock=_dose_cache_lock)
 def calculate_dose(dose_str, weight, age):
     """Detect weight-based dose and calculate safely; otherwise return conservative fixed dose."""
-    match = re.search(r"(\d+(\.\d+)?)(–(\d+(\.\d+)?))?\s*(mg|mcg|g)/kg", dose_str)
+    match = _PER_KG_DOSE_RE.search(dose_str)
     if match:
         low = float(match.group(1))
         high = float(match.group(4)) if match.group(4) else low
@@ -1391,7 +1991,7 @@ def calculate_dose(dose_str, weight, age):
         suffix = dose_str[dose_str.find(unit + "/kg") + len(unit) + 3:]
         return calc_dose + suffix
     else:
-        range_match = re.search(r"(\d+)(–(\d+))?\s*(mg|mcg|g)", dose_str)
+        range_match = _FIXED_DOSE_RE.search(dose_str)
         if range_match:
             low = int(range_match.group(1))
             high = int(range_match.group(3)) if range_match.group(3) else low
@@ -1444,21 +2044,96 @@ def recommend_dose(drug_name: str, age_years: float, weight_kg: Optional[float]
         "max_per_day": max_dose_adjusted
     }
 
+@st.cache_data(max_entries=2048, show_spinner=False)
 def suggest_alternatives(drug_name: str):
-    return ALTERNATIVE_MAP.get(drug_name.lower(), [])
+    key = drug_name.lower().strip()
+    if key not in ALTERNATIVE_INDEX:
+        # Tolerate small misspellings of indexed names
+        match = process.extractOne(key, ALTERNATIVE_INDEX.keys(), scorer=fuzz.ratio, score_cutoff=85)
+        if not match:
+            return []
+        key = match[0]
+    return ALTERNATIVE_INDEX[key]
+
+SPACY_BATCH_SIZE = int(os.getenv("SPACY_BATCH_SIZE", "32"))
+EXTRACTION_NOTE = "This is a demo extractor; use medSpaCy for production."
+# Rows shown per page of the extraction results table
+RESULTS_PAGE_SIZE = 50
+
+_DOSE_RE = re.compile(r"\b\d+(?:\.\d+)?\s*(?:mg|mcg|g|units|ml)\b", re.I)
+# Free-text name followed by a dose, used by the spaCy fallback path
+_NAME_DOSE_RE = re.compile(r"([A-Za-z0-9\-\_ ]+?)\s+(\d+(?:\.\d+)?\s*(?:mg|mcg|g|units|ml))", re.I)
+_PARAGRAPH_SPLIT_RE = re.compile(r"\n\s*\n")
+DOSE_WINDOW_CHARS = 40
+
+@st.cache_resource
+def load_drug_matcher(names: tuple):
+    """Matcher for a drug vocabulary: an Aho-Corasick automaton, or a compiled regex without pyahocorasick"""
+    if AHOCORASICK_AVAILABLE:
+        automaton = ahocorasick.Automaton()
+        for name in names:
+            automaton.add_word(name.lower(), name.lower())
+        automaton.make_automaton()
+        return automaton
+    alternation = "|".join(sorted(map(re.escape, names), key=len, reverse=True))
+    return re.compile(r"\b(?:" + alternation + r")\b", re.I)
+
+def find_drug_names(text: str, names: tuple) -> List[tuple]:
+    """(start, end, name) spans of whole-word vocabulary names in text, in order of appearance"""
+    matcher = load_drug_matcher(names)
+    if not AHOCORASICK_AVAILABLE:
+        return [(m.start(), m.end(), m.group(0).lower()) for m in matcher.finditer(text)]
+    lowered = text.lower()
+    spans = []
+    for last, name in matcher.iter(lowered):
+        start, end = last - len(name) + 1, last + 1
+        if (start == 0 or not lowered[start - 1].isalnum()) and (end == len(lowered) or not lowered[end].isalnum()):
+            spans.append((start, end, name))
+    return spans
+
+def extract_med_info_fast(text: str) -> Optional[List[Dict]]:
+    """Dictionary extraction; returns None unless every dose in the text is paired with a known drug name.
+
+    Doses next to names outside the medications table are left to the spaCy path.
+    """
+    found = []
+    claimed_doses = set()
+    hits = find_drug_names(text, MEDICATION_NAMES)
+    for i, (_, end, name) in enumerate(hits):
+        # Pair each name with the first dose after it, before the next name
+        window_end = min(end + DOSE_WINDOW_CHARS, hits[i + 1][0] if i + 1 < len(hits) else len(text))
+        dose = _DOSE_RE.search(text, end, window_end)
+        if dose:
+            found.append({"name": name, "dose": dose.group(0)})
+            claimed_doses.add(dose.start())
+    if found and len(claimed_doses) == len(_DOSE_RE.findall(text)):
+        return found
+    return None
+
+@st.cache_resource
+def load_nlp():
+    """Load the spaCy pipeline once per process, keeping only sentence splitting"""
+    import spacy
+    nlp = spacy.load("en_core_web_sm", exclude=["tok2vec", "tagger", "parser", "attribute_ruler", "lemmatizer", "ner"])
+    nlp.add_pipe("sentencizer")
+    return nlp
 
 def extract_med_info(text: str):
     """Simple spaCy-based extraction template."""
+    meds = extract_med_info_fast(text)
+    if meds is not None:
+        return {"extracted_medications": meds, "note": EXTRACTION_NOTE}
     try:
-        import spacy
-        nlp = spacy.load("en_core_web_sm")
-        doc = nlp(text)
+        nlp = load_nlp()
+        # Paragraphs are batched through nlp.pipe and matched sentence by sentence
+        segments = [seg for seg in _PARAGRAPH_SPLIT_RE.split(text) if seg.strip()]
         meds = []
-        pattern = r"([A-Za-z0-9\-\_ ]+?)\s+(\d+(?:\.\d+)?\s*(?:mg|mcg|g|units|ml))"
-        matches = re.findall(pattern, text, flags=re.I)
-        for m in matches:
-            meds.append({"name": m[0].strip(), "dose": m[1].strip()})
-        return {"extracted_medications": meds, "note": "This is a demo extractor; use medSpaCy for production."}
+        for doc in nlp.pipe(segments, batch_size=SPACY_BATCH_SIZE, n_process=1):
+            for sent in doc.sents:
+                matches = _NAME_DOSE_RE.findall(sent.text)
+                for m in matches:
+                    meds.append({"name": m[0].strip().lower(), "dose": m[1].strip()})
+        return {"extracted_medications": meds, "note": EXTRACTION_NOTE}
     except Exception as e:
         return {"error": "spaCy not installed or model missing; see app requirements."}
 